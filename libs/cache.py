@@ -0,0 +1,99 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class LruCache:
+
+    def __init__(self, max_bytes: int):
+        """
+        A thread-safe least recently used (LRU) cache for numpy arrays, which is bounded by the total memory size of
+        the cached arrays. If adding an array exceeds the memory limit, the least recently used arrays will be evicted.
+        The cache keeps track of hits and misses, so that its efficiency can be monitored.
+
+        Parameters
+        ----------
+        max_bytes: int
+            Maximum memory size in bytes of all cached arrays
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Gets a cached array and marks it as most recently used.
+
+        Parameters
+        ----------
+        key
+            Hashable key of the array
+
+        Returns
+        -------
+        numpy.ndarray:
+            The cached (read-only) array or None, if the cache does not contain an array for the key.
+
+        """
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value: np.ndarray):
+        """
+        Adds an array to the cache. Arrays that are larger than the memory limit will not be cached.
+
+        Parameters
+        ----------
+        key
+            Hashable key of the array
+        value: numpy.ndarray
+            Array to cache. It will be marked as read-only.
+
+        """
+        if value.nbytes > self.max_bytes:
+            return
+        value.flags.writeable = False
+        with self._lock:
+            old_value = self._data.pop(key, None)
+            if old_value is not None:
+                self.nbytes -= old_value.nbytes
+            self._data[key] = value
+            self.nbytes += value.nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.
+
+    def stats(self):
+        """
+        Returns
+        -------
+        dict:
+            Number of hits and misses, hit rate, number of cached arrays and their memory size in bytes
+
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hit_rate, "size": len(self._data),
+                    "nbytes": self.nbytes}
+
+    def __len__(self):
+        return len(self._data)
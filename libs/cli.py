@@ -0,0 +1,132 @@
+import argparse
+
+# Only the standard library is imported at module level. Each subcommand imports the modules it needs, so that e.g.
+# downloading files does not pay the startup time of numpy, xarray, geopandas or tensorflow.
+
+DOWNLOAD_PRODUCTS = ["soil_temperature_5cm", "hyras_air_temperature_min", "hyras_air_temperature_max",
+                     "hyras_humidity", "hyras_precipitation", "hyras_radiation_global"]
+LOAD_PRODUCTS = ["regnie", "soil_temperature_5cm"]
+CATALOG_PRODUCTS = ["regnie", "soil_temperature_5cm", "hyras", "regnie_clipped", "hyras_clipped"]
+
+
+def download(args):
+    from libs.dwd import cdc
+
+    cdc.download_cdc_product(args.outdir, list(range(args.startyear, args.endyear + 1)), args.product)
+
+
+def load(args):
+    from libs.dwd import catalog as dwdcatalog
+    from libs.dwd import grid as dwdgrid
+
+    catalog = None
+    if args.catalog:
+        catalog = dwdcatalog.Catalog(args.catalog)
+
+    if args.product == "regnie":
+        dwdgrid.load_and_store_regnie_files(args.startdate, args.enddate, args.inputdir, args.outdir,
+                                            args.singlestorage, catalog)
+    elif args.product == "soil_temperature_5cm":
+        dwdgrid.load_and_store_ambeti_files(args.startdate, args.enddate, args.inputdir, args.outdir,
+                                            args.singlestorage, catalog)
+
+    if catalog is not None:
+        catalog.close()
+
+
+def merge_hyras(args):
+    from libs.dwd import catalog as dwdcatalog
+    from libs.dwd import grid as dwdgrid
+
+    catalog = dwdcatalog.Catalog(args.catalog) if args.catalog else None
+    dwdgrid.merge_and_clip_hyras(args.inputdir, args.geompath, args.outpath, args.startyear, args.endyear,
+                                 args.variable, args.version, args.resolution, catalog)
+    if catalog is not None:
+        catalog.close()
+
+
+def catalog_scan(args):
+    from libs.dwd import catalog as dwdcatalog
+
+    with dwdcatalog.Catalog(args.catalog) as catalog:
+        for directory in args.dirs:
+            nr_updated = catalog.scan(directory)
+            print(f"Updated {nr_updated} catalog entries for directory {directory}.")
+
+
+def catalog_query(args):
+    from libs.dwd import catalog as dwdcatalog
+
+    with dwdcatalog.Catalog(args.catalog) as catalog:
+        df_files = catalog.query(args.product, args.startdate, args.enddate, args.format, args.variable,
+                                 base_path=args.basepath)
+    for row in df_files.itertuples():
+        print(f"{row.path}\t{row.start_date}\t{row.end_date}\t{row.time_offset}")
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description="Download, load and catalog DWD climate data products.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    download_parser = subparsers.add_parser("download", help="Download climate data from DWD CDC portal.")
+    download_parser.add_argument("-o", "--outdir", type=str, help="Directory that will be used for storing downloaded"
+                                                                  " files.")
+    download_parser.add_argument("-s", "--startyear", type=int, help="Start year for file download.")
+    download_parser.add_argument("-e", "--endyear", type=int, help="End year for file download.")
+    download_parser.add_argument("-p", "--product", type=str, choices=DOWNLOAD_PRODUCTS, help="Data product to"
+                                                                                              " download.")
+    download_parser.set_defaults(func=download)
+
+    load_parser = subparsers.add_parser("load", help="Load DWD ASCII files and store them as NetCDF files.")
+    load_parser.add_argument("-i", "--inputdir", type=str, help="Directory that contains folders with yearly files.")
+    load_parser.add_argument("-o", "--outdir", type=str, help="Directory that will be used for storing results.")
+    load_parser.add_argument("-s", "--startdate", type=int, help="Start year for loading data.")
+    load_parser.add_argument("-e", "--enddate", type=int, help="End year for loading data.")
+    load_parser.add_argument("-p", "--product", type=str, choices=LOAD_PRODUCTS, help="DWD data product to load.")
+    load_parser.add_argument("-S", "--singlestorage", action="store_true", help="If set, one single NetCDF file will"
+                                                                                " be stored for all years, rather than"
+                                                                                " storing a separate file for each"
+                                                                                " year.")
+    load_parser.add_argument("-c", "--catalog", type=str, help="Path to a catalog database, which will be used for"
+                                                               " looking up input files and registering results. Use"
+                                                               " 'catalog scan' for adding the input files.")
+    load_parser.set_defaults(func=load)
+
+    merge_parser = subparsers.add_parser("merge-hyras", help="Merge yearly HYRAS files and clip them by a geometry.")
+    merge_parser.add_argument("-i", "--inputdir", type=str, help="Directory that contains folders with yearly HYRAS"
+                                                                 " files.")
+    merge_parser.add_argument("-g", "--geompath", type=str, help="Path to a file with the clipping geometry.")
+    merge_parser.add_argument("-o", "--outpath", type=str, help="Path of the resulting NetCDF file.")
+    merge_parser.add_argument("-s", "--startyear", type=int, help="Start year.")
+    merge_parser.add_argument("-e", "--endyear", type=int, help="End year (inclusive).")
+    merge_parser.add_argument("-v", "--variable", type=str, help="HYRAS variable prefix (e.g. 'pr').")
+    merge_parser.add_argument("-V", "--version", type=str, help="HYRAS file version (e.g. 'v3-0').")
+    merge_parser.add_argument("-r", "--resolution", type=int, help="Resolution of the HYRAS files in km.")
+    merge_parser.add_argument("-c", "--catalog", type=str, help="Path to a catalog database, which will be used for"
+                                                                " looking up input files and registering the result.")
+    merge_parser.set_defaults(func=merge_hyras)
+
+    catalog_parser = subparsers.add_parser("catalog", help="Manage a catalog of local DWD files.")
+    catalog_subparsers = catalog_parser.add_subparsers(dest="catalog_command", required=True)
+
+    scan_parser = catalog_subparsers.add_parser("scan", help="Add all files within directories to the catalog.")
+    scan_parser.add_argument("-c", "--catalog", type=str, required=True, help="Path to the catalog database.")
+    scan_parser.add_argument("dirs", type=str, nargs="+", help="Directories to scan.")
+    scan_parser.set_defaults(func=catalog_scan)
+
+    query_parser = catalog_subparsers.add_parser("query", help="List catalog files that overlap with a date range.")
+    query_parser.add_argument("-c", "--catalog", type=str, required=True, help="Path to the catalog database.")
+    query_parser.add_argument("-p", "--product", type=str, choices=CATALOG_PRODUCTS, help="DWD data product.")
+    query_parser.add_argument("-s", "--startdate", type=str, help="Start date in the format 'yyyy-mm-dd'.")
+    query_parser.add_argument("-e", "--enddate", type=str, help="End date (inclusive) in the format 'yyyy-mm-dd'.")
+    query_parser.add_argument("-f", "--format", type=str, choices=["ascii", "netcdf"], help="File format.")
+    query_parser.add_argument("-v", "--variable", type=str, help="HYRAS variable prefix (e.g. 'pr').")
+    query_parser.add_argument("-d", "--basepath", type=str, help="Only list files within this directory.")
+    query_parser.set_defaults(func=catalog_query)
+
+    return parser
+
+
+def main(argv: list = None):
+    args = create_parser().parse_args(argv)
+    args.func(args)
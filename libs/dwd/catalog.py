@@ -0,0 +1,292 @@
+import hashlib
+import os
+import re
+import sqlite3
+
+REGNIE = "regnie"
+AMBETI = "soil_temperature_5cm"
+HYRAS = "hyras"
+# Products of NetCDF files, which have been merged and clipped by libs.dwd.grid
+REGNIE_CLIPPED = "regnie_clipped"
+HYRAS_CLIPPED = "hyras_clipped"
+
+ASCII_FORMAT = "ascii"
+NETCDF_FORMAT = "netcdf"
+
+REGNIE_EPSG = 4326
+AMBETI_EPSG = 31467
+HYRAS_EPSG = 3034
+
+# Patterns for the names of DWD files and of the NetCDF files created by libs.dwd.grid. Each entry holds the product,
+# the file format and the pattern, whose named groups determine the date range and grid of a file.
+FILE_PATTERNS = [
+    (REGNIE, ASCII_FORMAT, re.compile(r"^ra(?P<yy>\d{2})(?P<month>\d{2})(?P<day>\d{2})\.gz$")),
+    (REGNIE, NETCDF_FORMAT, re.compile(r"^regnie_(?P<year>\d{4}|full)\.nc$")),
+    (AMBETI, ASCII_FORMAT, re.compile(
+        r"^grids_germany_daily_soil_temperature_5cm_(?P<year>\d{4})(?P<month>\d{2})(?P<day>\d{2})\.asc$")),
+    (AMBETI, NETCDF_FORMAT, re.compile(r"^grids_germany_daily_soil_temperature_5cm_(?P<year>\d{4}|full)\.nc$")),
+    (HYRAS, NETCDF_FORMAT, re.compile(
+        r"^(?P<variable>[a-z]+)_hyras_(?P<resolution>\d+)_(?P<year>\d{4})_(?P<version>v\d+-\d+)_de\.nc$")),
+]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    product TEXT NOT NULL,
+    format TEXT NOT NULL,
+    variable TEXT,
+    version TEXT,
+    grid TEXT,
+    epsg INTEGER,
+    start_date TEXT NOT NULL,
+    end_date TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    checksum TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_files_product_dates ON files (product, start_date, end_date);
+"""
+
+
+def parse_file_name(path: str):
+    """
+    Parses the name of a DWD file or a NetCDF file created by libs.dwd.grid and derives the product, format, date
+    range and grid of the file. Files that comprise all years ('*_full.nc') have no date range within their name.
+    In this case, start and end date are None.
+
+    Parameters
+    ----------
+    path: str
+        Path to the file.
+
+    Returns
+    -------
+    dict:
+        Dictionary with product, format, variable, version, grid, epsg, start_date and end_date ('yyyy-mm-dd') or
+        None if the file name does not match any known pattern.
+
+    """
+    file_name = os.path.basename(path)
+    for product, file_format, pattern in FILE_PATTERNS:
+        match = pattern.match(file_name)
+        if match is None:
+            continue
+        groups = match.groupdict()
+        entry = dict(product=product, format=file_format, variable=groups.get("variable"),
+                     version=groups.get("version"), start_date=None, end_date=None)
+        if "yy" in groups:
+            # REGNIE files only contain a two-digit year, but are stored within yearly directories 'ra<yyyy>m'
+            dir_match = re.search(r"ra(\d{4})m", os.path.basename(os.path.dirname(path)))
+            if dir_match:
+                year = int(dir_match.group(1))
+            else:
+                year = int(groups["yy"]) + (1900 if int(groups["yy"]) >= 30 else 2000)
+            groups["year"] = str(year)
+        if "day" in groups:
+            entry["start_date"] = entry["end_date"] = f"{groups['year']}-{groups['month']}-{groups['day']}"
+        elif groups["year"] != "full":
+            entry["start_date"] = f"{groups['year']}-01-01"
+            entry["end_date"] = f"{groups['year']}-12-31"
+        if product == REGNIE:
+            entry["grid"], entry["epsg"] = "611x971", REGNIE_EPSG
+        elif product == AMBETI:
+            entry["grid"], entry["epsg"] = "654x866", AMBETI_EPSG
+        else:
+            entry["grid"], entry["epsg"] = f"{groups['resolution']}km", HYRAS_EPSG
+        return entry
+    return None
+
+
+def file_checksum(path: str, chunk_size: int = 2 ** 20):
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class Catalog:
+
+    def __init__(self, db_path: str):
+        """
+        A persistent SQLite catalog of local REGNIE, AMBETI and HYRAS files as well as of the NetCDF files created
+        from them. For each file, the catalog records product, format, date range, grid, CRS and checksum, so that
+        files for a certain date range can be resolved without scanning directories or opening NetCDF files.
+
+        Parameters
+        ----------
+        db_path: str
+            Path to the SQLite database file. It will be created, if it does not exist.
+        """
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        self.conn.executescript(SCHEMA)
+
+    def add(self, path: str, force: bool = False):
+        """
+        Adds a file to the catalog or updates its entry. Files, whose size and modification time did not change since
+        they have been added, will be skipped. Only NetCDF files without a date range in their file name will be
+        opened for determining their date range.
+
+        Parameters
+        ----------
+        path: str
+            Path to the file
+        force: bool
+            Indicates whether to update the entry even if the file did not change. Default: False
+
+        Returns
+        -------
+        bool:
+            True, if the file has been added or updated, else False
+
+        """
+        path = os.path.abspath(path)
+        entry = parse_file_name(path)
+        if entry is None:
+            raise ValueError(f"Unsupported file name: {path}")
+        if not force:
+            stat = os.stat(path)
+            row = self.conn.execute("SELECT size, mtime FROM files WHERE path = ?", (path,)).fetchone()
+            if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime:
+                return False
+        self.__store(path, entry)
+        return True
+
+    def register(self, path: str, product: str, start_date: str = None, end_date: str = None,
+                 file_format: str = NETCDF_FORMAT, variable: str = None, version: str = None, grid: str = None,
+                 epsg: int = None):
+        """
+        Adds a file with explicit metadata to the catalog or updates its entry. This allows for cataloging files,
+        whose names do not match any known pattern, such as merged and clipped NetCDF files.
+
+        Parameters
+        ----------
+        path: str
+            Path to the file
+        product: str
+            Product of the file (e.g. 'hyras_clipped')
+        start_date: str
+            Start date in the format 'yyyy-mm-dd'. If not specified, the file will be opened for determining its date
+            range.
+        end_date: str
+            End date (inclusive) in the format 'yyyy-mm-dd'
+        file_format: str
+            File format. Default: 'netcdf'
+        variable: str
+            Variable of the file
+        version: str
+            Version of the file
+        grid: str
+            Grid of the file
+        epsg: int
+            EPSG code of the file's CRS
+
+        """
+        entry = dict(product=product, format=file_format, variable=variable, version=version, grid=grid, epsg=epsg,
+                     start_date=start_date, end_date=end_date)
+        self.__store(os.path.abspath(path), entry)
+
+    def __store(self, path: str, entry: dict):
+        stat = os.stat(path)
+        if entry["start_date"] is None:
+            # Imported on demand, since scanning a catalog otherwise only requires the standard library
+            import pandas as pd
+            import xarray as xr
+            with xr.open_dataset(path) as xds:
+                entry["start_date"] = pd.Timestamp(xds.time.values.min()).strftime("%Y-%m-%d")
+                entry["end_date"] = pd.Timestamp(xds.time.values.max()).strftime("%Y-%m-%d")
+        entry.update(path=path, size=stat.st_size, mtime=stat.st_mtime, checksum=file_checksum(path))
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO files (path, product, format, variable, version, grid, epsg, start_date, "
+                "end_date, size, mtime, checksum) VALUES (:path, :product, :format, :variable, :version, :grid, :epsg, "
+                ":start_date, :end_date, :size, :mtime, :checksum)", entry)
+
+    def scan(self, base_path: str):
+        """
+        Recursively scans a directory and adds all files with a known file name to the catalog. Entries of files
+        below the directory, which do not exist anymore, will be removed.
+
+        Parameters
+        ----------
+        base_path: str
+            Path to the directory
+
+        Returns
+        -------
+        int:
+            Number of added or updated files
+
+        """
+        base_path = os.path.abspath(base_path)
+        nr_updated = 0
+        for dir_path, _, file_names in os.walk(base_path):
+            for file_name in file_names:
+                path = os.path.join(dir_path, file_name)
+                if parse_file_name(path) is not None and self.add(path):
+                    nr_updated += 1
+        prefix = os.path.join(base_path, "")
+        paths = [row[0] for row in self.conn.execute("SELECT path FROM files WHERE substr(path, 1, ?) = ?",
+                                                     (len(prefix), prefix))]
+        with self.conn:
+            self.conn.executemany("DELETE FROM files WHERE path = ?", [(p,) for p in paths if not os.path.exists(p)])
+        return nr_updated
+
+    def query(self, product: str, start_date: str, end_date: str, file_format: str = None, variable: str = None,
+              version: str = None, grid: str = None, base_path: str = None):
+        """
+        Queries all files of a product that overlap with a date range. The query does not touch the file system, so
+        files have to be added to the catalog beforehand, e.g. by scanning their directories.
+
+        Parameters
+        ----------
+        product: str
+            Product (e.g. 'regnie', 'soil_temperature_5cm', 'hyras' or 'hyras_clipped')
+        start_date: str
+            Start date in the format 'yyyy-mm-dd'
+        end_date: str
+            End date (inclusive) in the format 'yyyy-mm-dd'
+        file_format: str
+            File format ('ascii' or 'netcdf'). If not specified, files of all formats will be considered.
+        variable: str
+            Variable prefix of HYRAS files (e.g. 'pr')
+        version: str
+            Version of HYRAS files (e.g. 'v3-0')
+        grid: str
+            Grid of the files (e.g. '5km' for HYRAS files with 5 km resolution)
+        base_path: str
+            Directory, which the files must be located in (including subdirectories). If not specified, files of all
+            directories will be considered.
+
+        Returns
+        -------
+        pandas.DataFrame:
+            Catalog entries ordered by start date. The column 'time_offset' holds the index of the first day within
+            each file that lies within the date range.
+
+        """
+        import pandas as pd
+
+        sql = "SELECT * FROM files WHERE product = ? AND start_date <= ? AND end_date >= ?"
+        params = [product, end_date, start_date]
+        for column, value in [("format", file_format), ("variable", variable), ("version", version), ("grid", grid)]:
+            if value is not None:
+                sql += f" AND {column} = ?"
+                params.append(value)
+        if base_path is not None:
+            prefix = os.path.join(os.path.abspath(base_path), "")
+            sql += " AND substr(path, 1, ?) = ?"
+            params.extend([len(prefix), prefix])
+        df_files = pd.read_sql_query(sql + " ORDER BY start_date, path", self.conn, params=params)
+        df_files["time_offset"] = (pd.to_datetime(start_date) - pd.to_datetime(df_files["start_date"])).dt.days.clip(0)
+        return df_files
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
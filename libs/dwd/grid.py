@@ -2,11 +2,17 @@ import numpy as np
 import pandas as pd
 import xarray as xr
 import rioxarray as rio
-import geopandas as gpd
 import glob
 import os
+from rasterio import features
 from rasterio.enums import Resampling
 
+from libs.dwd import catalog as dwdcatalog
+from libs.lazy import lazy_import
+
+# geopandas is only required for clipping and lumping and is therefore imported on first use
+gpd = lazy_import("geopandas")
+
 REGNIE_X_DELTA = 1 / 60
 REGNIE_Y_DELTA = 1 / 120
 REGNIE_X_OFFSET = (6 - 10 * REGNIE_X_DELTA) - REGNIE_X_DELTA / 2
@@ -95,7 +101,8 @@ def ambeti_as_xarray(path: str, date: str):
     return xds
 
 
-def load_and_store_regnie_files(start_year: int, end_year: int, base_path: str, out_path: str, single_year_storage: bool = True):
+def load_and_store_regnie_files(start_year: int, end_year: int, base_path: str, out_path: str, single_year_storage: bool = True,
+                                catalog: dwdcatalog.Catalog = None):
     """
     Loads multiple REGNIE files for the specified years from a base directory as xarray.Dataset and stores it as NetCDF
     files.
@@ -113,17 +120,29 @@ def load_and_store_regnie_files(start_year: int, end_year: int, base_path: str,
     single_year_storage: bool
         Indicates whether to store NetCDF files for each year or one single NetCDF files, that comprises
         REGNIE data for all years.
+    catalog: libs.dwd.catalog.Catalog
+        Catalog for looking up the input files within the base directory, instead of searching the base directory.
+        The input files must have been added to the catalog beforehand, e.g. by scanning the base directory.
+        Resulting NetCDF files will be added to the catalog.
 
     """
     years = list(range(start_year, end_year + 1))
     dir_paths = [f"{base_path}/ra{year}m" for year in years]
     xds_list = []
     for year, dir_path in zip(years, dir_paths):
-        file_paths = glob.glob(f"{dir_path}/ra**.gz", recursive=True)
+        if catalog is not None:
+            df_files = catalog.query(dwdcatalog.REGNIE, f"{year}-01-01", f"{year}-12-31", dwdcatalog.ASCII_FORMAT,
+                                     base_path=dir_path)
+            file_paths = list(df_files["path"])
+            if len(file_paths) == 0:
+                raise FileNotFoundError(f"Catalog {catalog.db_path} does not contain REGNIE files for year {year} "
+                                        f"within directory {dir_path}.")
+        else:
+            file_paths = glob.glob(f"{dir_path}/ra**.gz", recursive=True)
         nr_files = len(file_paths)
         if len(file_paths) == 0:
             raise FileNotFoundError(f"Can't find files within directory {dir_path}.")
-        dates = [f"{year}-{fp[4:6]}-{fp[6:8]}" for fp in [os.path.basename(fp) for fp in file_paths]]
+        dates = [dwdcatalog.parse_file_name(fp)["start_date"] for fp in file_paths]
         print(f"Read REGNIE files for year {year}.")
         for i, (fp, date) in enumerate(zip(file_paths, dates)):
             print(f"Reading file {i + 1} of {nr_files} from directory {dir_path}", end="\r")
@@ -136,15 +155,20 @@ def load_and_store_regnie_files(start_year: int, end_year: int, base_path: str,
             out_file_path = os.path.join(out_path, f"regnie_{year}.nc")
             xds.to_netcdf(out_file_path)
             print(f"Stored file {out_file_path}.")
+            if catalog is not None:
+                catalog.add(out_file_path)
             xds_list.clear()
     if not single_year_storage:
         xds = xr.concat(xds_list, dim="time")
         out_file_path = os.path.join(out_path, f"regnie_full.nc")
         xds.to_netcdf(out_file_path)
         print(f"Stored file {out_file_path}.")
+        if catalog is not None:
+            catalog.add(out_file_path)
 
 
-def load_and_store_ambeti_files(start_year: int, end_year: int, base_path: str, out_path: str, single_year_storage: bool = True):
+def load_and_store_ambeti_files(start_year: int, end_year: int, base_path: str, out_path: str, single_year_storage: bool = True,
+                                catalog: dwdcatalog.Catalog = None):
     """
     Loads multiple ASCII-files containing AMBETI soil temperature values for the specified years from a base directory
     as xarray.Dataset and stores it as NetCDF files.
@@ -162,17 +186,29 @@ def load_and_store_ambeti_files(start_year: int, end_year: int, base_path: str,
     single_year_storage: bool
         Indicates whether to store NetCDF files for each year or one single NetCDF files, that comprises
         REGNIE data for all years.
+    catalog: libs.dwd.catalog.Catalog
+        Catalog for looking up the input files within the base directory, instead of searching the base directory.
+        The input files must have been added to the catalog beforehand, e.g. by scanning the base directory.
+        Resulting NetCDF files will be added to the catalog.
 
     """
     years = list(range(start_year, end_year + 1))
     dir_paths = [f"{base_path}/{year}" for year in years]
     xds_list = []
     for year, dir_path in zip(years, dir_paths):
-        file_paths = glob.glob(f"{dir_path}/grids_germany_daily_soil_temperature_5cm_**.asc", recursive=True)
+        if catalog is not None:
+            df_files = catalog.query(dwdcatalog.AMBETI, f"{year}-01-01", f"{year}-12-31", dwdcatalog.ASCII_FORMAT,
+                                     base_path=dir_path)
+            file_paths = list(df_files["path"])
+            if len(file_paths) == 0:
+                raise FileNotFoundError(f"Catalog {catalog.db_path} does not contain soil temperature files for year "
+                                        f"{year} within directory {dir_path}.")
+        else:
+            file_paths = glob.glob(f"{dir_path}/grids_germany_daily_soil_temperature_5cm_**.asc", recursive=True)
         nr_files = len(file_paths)
         if len(file_paths) == 0:
             raise FileNotFoundError(f"Can't find files within directory {dir_path}.")
-        dates = [f"{fp[41:45]}-{fp[45:47]}-{fp[47:49]}" for fp in [os.path.basename(fp) for fp in file_paths]]
+        dates = [dwdcatalog.parse_file_name(fp)["start_date"] for fp in file_paths]
         print(f"Read ASCII files for year {year}.")
         for i, (fp, date) in enumerate(zip(file_paths, dates)):
             print(f"Reading file {i + 1} of {nr_files} from directory {dir_path}", end="\r")
@@ -185,15 +221,20 @@ def load_and_store_ambeti_files(start_year: int, end_year: int, base_path: str,
             out_file_path = os.path.join(out_path, f"grids_germany_daily_soil_temperature_5cm_{year}.nc")
             xds.to_netcdf(out_file_path)
             print(f"Stored file {out_file_path}.")
+            if catalog is not None:
+                catalog.add(out_file_path)
             xds_list.clear()
     if not single_year_storage:
         xds = xr.concat(xds_list, dim="time")
         out_file_path = os.path.join(out_path, f"grids_germany_daily_soil_temperature_5cm_full.nc")
         xds.to_netcdf(out_file_path)
         print(f"Stored file {out_file_path}.")
+        if catalog is not None:
+            catalog.add(out_file_path)
 
 
-def merge_and_clip_regnie(netcdf_path: str, geom_path: str, out_path: str, start_year: int, end_year: int):
+def merge_and_clip_regnie(netcdf_path: str, geom_path: str, out_path: str, start_year: int, end_year: int,
+                          catalog: dwdcatalog.Catalog = None):
     """
     Merges multiple REGNIE NetCDF files into a single one and clips it by using the bounding box of a dedicated geometry.
     All files that contain REGNIE data between the specified start and end date will be considered.
@@ -213,6 +254,8 @@ def merge_and_clip_regnie(netcdf_path: str, geom_path: str, out_path: str, start
         Start year for considering REGNIE NetCDF files
     end_year
         End year (inclusive) for considering REGNIE NetCDF files
+    catalog: libs.dwd.catalog.Catalog
+        Catalog, which the resulting NetCDF file will be added to as product 'regnie_clipped'.
 
     """
     file_paths = [os.path.join(netcdf_path, f"regnie_{year}.nc") for year in range(start_year, end_year + 1)]
@@ -233,10 +276,12 @@ def merge_and_clip_regnie(netcdf_path: str, geom_path: str, out_path: str, start
     xds_clipped["precipitation"].attrs.pop("grid_mapping", None)
 
     xds_clipped.to_netcdf(out_path)
+    if catalog is not None:
+        _register_clipped(catalog, out_path, xds_clipped, dwdcatalog.REGNIE_CLIPPED, "precipitation", 4326)
 
 
 def merge_and_clip_hyras(netcdf_path: str, geom_path: str, out_path: str, start_year: int, end_year: int,
-                         variable: str, version: str, resolution: int):
+                         variable: str, version: str, resolution: int, catalog: dwdcatalog.Catalog = None):
     """
     Merges multiple HYRAS NetCDF files into a single one and clips it by using the bounding box of a dedicated geometry.
     All files that contain HYRAS data between the specified start and end date will be considered.
@@ -259,9 +304,20 @@ def merge_and_clip_hyras(netcdf_path: str, geom_path: str, out_path: str, start_
         HYRAS file version (e.g.,
     resolution: int
         Resolution of the HYRAS file in km
+    catalog: libs.dwd.catalog.Catalog
+        Catalog for looking up the HYRAS files within the NetCDF directory, instead of deriving their paths. The
+        resulting NetCDF file will be added to the catalog as product 'hyras_clipped'.
     """
-    file_paths = [os.path.join(netcdf_path, str(year), f"{variable}_hyras_{resolution}_{year}_{version}_de.nc")
-                  for year in range(start_year, end_year + 1)]
+    if catalog is not None:
+        df_files = catalog.query(dwdcatalog.HYRAS, f"{start_year}-01-01", f"{end_year}-12-31", variable=variable,
+                                 version=version, grid=f"{resolution}km", base_path=netcdf_path)
+        file_paths = list(df_files["path"])
+        if len(file_paths) == 0:
+            raise FileNotFoundError(f"Catalog {catalog.db_path} does not contain HYRAS {variable} files for years "
+                                    f"{start_year} to {end_year} within directory {netcdf_path}.")
+    else:
+        file_paths = [os.path.join(netcdf_path, str(year), f"{variable}_hyras_{resolution}_{year}_{version}_de.nc")
+                      for year in range(start_year, end_year + 1)]
 
     xds = xr.open_mfdataset(file_paths, parallel=False)
     xds.rio.write_crs(3034, inplace=True)
@@ -280,9 +336,12 @@ def merge_and_clip_hyras(netcdf_path: str, geom_path: str, out_path: str, start_
     xds_clipped[variable].attrs.pop("grid_mapping", None)
 
     xds_clipped.to_netcdf(out_path)
+    if catalog is not None:
+        _register_clipped(catalog, out_path, xds_clipped, dwdcatalog.HYRAS_CLIPPED, variable, 3034, version)
 
 
-def merge_and_clip(file_paths: list, geom_path: str, out_path: str, variable: str, epsg: int):
+def merge_and_clip(file_paths: list, geom_path: str, out_path: str, variable: str, epsg: int,
+                   catalog: dwdcatalog.Catalog = None, product: str = None):
     """
     Merges multiple NetCDF files into a single one and clips it by using the bounding box of a dedicated geometry.
     All files that contain variable values between the specified start and end date will be considered.
@@ -299,6 +358,10 @@ def merge_and_clip(file_paths: list, geom_path: str, out_path: str, variable: st
         Relevant variable (e.g. 'precipitation')
     epsg: int
         EPSG code of the NetCDF dataset, which wil be used for reprojecting the geom dataset.
+    catalog: libs.dwd.catalog.Catalog
+        Catalog, which the resulting NetCDF file will be added to.
+    product: str
+        Product of the resulting NetCDF file within the catalog. Default: '<variable>_clipped'
 
     """
 
@@ -323,6 +386,78 @@ def merge_and_clip(file_paths: list, geom_path: str, out_path: str, variable: st
     print("Start writing clipped dataset...")
     xds_clipped.to_netcdf(out_path)
     print("Finished writing clipped dataset.")
+    if catalog is not None:
+        _register_clipped(catalog, out_path, xds_clipped, product or f"{variable}_clipped", variable, epsg)
+
+
+def _register_clipped(catalog: dwdcatalog.Catalog, path: str, xds: xr.Dataset, product: str, variable: str, epsg: int,
+                      version: str = None):
+    catalog.register(path, product,
+                     start_date=pd.Timestamp(xds.time.values.min()).strftime("%Y-%m-%d"),
+                     end_date=pd.Timestamp(xds.time.values.max()).strftime("%Y-%m-%d"),
+                     variable=variable, version=version, grid=f"{xds.x.size}x{xds.y.size}", epsg=epsg)
+
+
+def lump_by_geometries(xds: xr.Dataset, geom_path: str, variables: list, epsg: int = 4326, id_col: str = "id"):
+    """
+    Reduces gridded variables to basin-lumped timeseries by averaging all grid cells that touch the geometry of a
+    basin. For each basin, a cell mask is computed once from its geometry, so that the data is read only once. The
+    resulting xarray.Dataset has a basin dimension, which is indexed by the IDs of the geometries, and a time
+    dimension.
+
+    If the variables already have a basin dimension (e.g. forcings that have been clipped for each basin separately),
+    the grid of each basin will be averaged by using the geometry with the same ID.
+
+    Parameters
+    ----------
+    xds: xarray.Dataset
+        Dataset that holds gridded variables with time, y and x dimensions and an optional basin dimension.
+    geom_path: str
+        Path to a file that contains the basin geometries (e.g. './data/wv_subbasins.geojson').
+    variables: list
+        List of variables that will be lumped
+    epsg: int
+        EPSG code of the dataset, which will be used if the dataset does not provide a CRS itself. Default: 4326
+    id_col: str
+        Column of the geometry file that holds the basin IDs. Default: 'id'
+
+    Returns
+    -------
+    xarray.Dataset:
+        Dataset that holds the lumped variables with basin and time dimensions.
+
+    """
+    xds = xds[variables]
+    if xds.rio.crs is None:
+        xds = xds.rio.write_crs(epsg)
+    xds = xds.rio.set_spatial_dims(x_dim="x", y_dim="y")
+    transform = xds.rio.transform()
+    crs = xds.rio.crs
+    xds = xds.drop_vars("spatial_ref", errors="ignore").load()
+
+    geoms = gpd.read_file(geom_path)
+    geoms = geoms.to_crs(crs)
+    geoms_by_id = dict(zip([str(basin_id) for basin_id in geoms[id_col]], geoms.geometry))
+
+    basin_indexed = "basin" in xds.dims
+    if basin_indexed:
+        missing_basins = [str(basin) for basin in xds.basin.values if str(basin) not in geoms_by_id]
+        if missing_basins:
+            raise ValueError(f"Geometry file {geom_path} does not contain geometries for the basins {missing_basins}.")
+        basin_ids = list(xds.basin.values)
+    else:
+        basin_ids = list(geoms_by_id.keys())
+
+    xds_list = []
+    for basin_id in basin_ids:
+        mask = features.geometry_mask([geoms_by_id[str(basin_id)]], out_shape=(xds.y.size, xds.x.size),
+                                      transform=transform, all_touched=True, invert=True)
+        mask = xr.DataArray(mask, dims=["y", "x"], coords=dict(y=xds.y, x=xds.x))
+        xds_basin = xds.sel(basin=basin_id) if basin_indexed else xds
+        xds_basin = xds_basin.where(mask).mean(dim=["y", "x"], skipna=True)
+        xds_list.append(xds_basin.assign_coords(basin=basin_id))
+    xds_lumped = xr.concat(xds_list, dim="basin")
+    return xds_lumped.transpose("basin", "time")
 
 
 def resample(xds: xr.Dataset, upscale_factor: int, drop_vars: list):
@@ -1,15 +1,22 @@
 import math
+import os
 import numpy as np
 import pandas as pd
 from tensorflow.keras.utils import Sequence
 import xarray
 
+from libs.cache import LruCache
+from libs.dwd.catalog import file_checksum
+
 
 class CustomTimeseriesGenerator(Sequence):
 
-    def __init__(self, xds: xarray.Dataset, batch_size: int, timesteps: int, offset: int, feature_vars: list,
+    def __init__(self, xds: xarray.Dataset, batch_size: int, timesteps: int, offset, feature_vars: list,
                  target_var: str, drop_na: bool = False, joined_ouput: bool = False, basin_indexed: bool = True,
-                 input_shape: tuple = None, shuffle: bool = False):
+                 input_shape: tuple = None, shuffle: bool = False, num_shards: int = 1, shard_index: int = 0,
+                 shard_dim: str = "basin", rebalance_shards: bool = False, shuffle_mode: str = "full",
+                 block_size: int = 32, buffer_size: int = None, seed: int = None, cache_size_mb: float = 0,
+                 lumped: bool = False, geom_path: str = None, lumped_cache_path: str = None, epsg: int = 4326):
         """
         A custom TimeseriesGenerator that creates batches of timeseries from a xarray.Dataset and optionally takes
         also into account NaN values.
@@ -22,9 +29,12 @@ class CustomTimeseriesGenerator(Sequence):
             Size of the batches that will be created
         timesteps: int
             How many timesteps will be used for creating the input (forcings) timeseries
-        offset: int
+        offset: int or list
             Offset between inputs (forcings) and target (streamflow). An offset of 1 means that forcings for the last
-            n-days will be taken as input and the the streamflow for n + 1 will be taken as target.
+            n-days will be taken as input and the the streamflow for n + 1 will be taken as target. If a list of
+            offsets is given (e.g. [1, 2, ..., 7] for lead times of up to 7 days), each input window is extracted once
+            and the targets of a sample comprise the streamflow for all offsets with shape (horizon, basins). The
+            horizon dimension follows the order of the given offsets, which must not contain duplicates.
         feature_vars: list
             List of variables that should be used as input features
         target_vars: list
@@ -43,53 +53,266 @@ class CustomTimeseriesGenerator(Sequence):
             Shape of the inputs to be used for generating time windows. If not specified, the input shape will be
             computed automatically from the given xarray.Dataset.
         shuffle: bool
-            Indicates whether to shuffle the samples or not.
+            Indicates whether to shuffle the samples or not. If True, the samples will be reshuffled at the end of each
+            epoch.
+        num_shards: int
+            Number of shards (e.g. workers or data loader processes) the samples will be partitioned into. Each shard
+            only opens its own slice of the xarray.Dataset. Default: 1
+        shard_index: int
+            Index (rank) of the shard this generator serves, in the range [0, num_shards). Default: 0
+        shard_dim: str
+            Dimension used for partitioning the samples into shards. 'basin' assigns a subset of basins to each shard,
+            'time' assigns a contiguous block of target dates to each shard. Sharding by 'basin' is not supported for
+            joined outputs, since a joined sample comprises all basins. Since synchronous distributed training
+            requires the same number of steps for each worker, the samples of each shard are truncated to the number
+            of samples of the smallest shard. Default: 'basin'
+        rebalance_shards: bool
+            Indicates whether to rotate the shard assignment deterministically at the end of each epoch, so that each
+            worker sees each shard over the course of num_shards epochs. Note, that this rotates the shards, but does
+            not balance their sizes. This keeps a reference to the full xarray.Dataset, which therefore should be
+            opened lazily. Default: False
+        shuffle_mode: str
+            Strategy used for shuffling the samples. 'full' shuffles all samples randomly. 'block' shuffles contiguous
+            blocks of timesteps and afterwards shuffles the samples within a bounded buffer, so that consecutive samples
+            read overlapping time windows and chunks of the underlying data. Default: 'full'
+        block_size: int
+            Number of consecutive timesteps that form a block for shuffle_mode 'block'. Default: 32
+        buffer_size: int
+            Number of consecutive samples that will be shuffled among each other after shuffling the blocks for
+            shuffle_mode 'block'. If not specified, the batch size will be used.
+        seed: int
+            Seed for the random number generator used for shuffling. Together with the epoch, it determines the order
+            of the samples, so that each epoch is reproducible. If not specified, the order will not be reproducible.
+        cache_size_mb: float
+            Maximum memory size in MB of a LRU cache, which holds the decoded daily input grids keyed by variable,
+            basin and time index. Since consecutive samples share timesteps-1 days and, without basin indexed inputs,
+            all basins share the same grids, this avoids repeatedly reading the same data from lazily opened datasets.
+            The cache is safe to use from multiple worker threads. If 0, no cache will be used. Default: 0
+        lumped: bool
+            Indicates whether gridded input features should be reduced to basin-lumped timeseries by averaging them
+            over the basin geometries. Lumping is done once and the lumped inputs are held in memory, which will be
+            used as basin indexed inputs. For joined outputs, a sample contains the input timeseries of all basins
+            with shape (timesteps, basins, features). Default: False
+        geom_path: str
+            Path to a file that contains the basin geometries used for lumping (e.g. './data/wv_subbasins.geojson').
+            Required for lumped inputs, unless the lumped inputs will be loaded from 'lumped_cache_path'.
+        lumped_cache_path: str
+            Path to a NetCDF file for caching the lumped inputs. If the file exists, the lumped inputs will be loaded
+            from it. Otherwise, the lumped inputs will be computed and stored to this file. The cache file records path
+            and checksum of the geometry file as well as the EPSG code. If they differ from 'geom_path' and 'epsg', the
+            lumped inputs will be recomputed and the cache file will be overwritten. A ValueError is raised, if the
+            cached lumped inputs do not contain all feature variables, timesteps and basins of the dataset.
+        epsg: int
+            EPSG code of the xarray.Dataset, which will be used for lumping if the dataset does not provide a CRS
+            itself. Default: 4326
         """
+        if num_shards < 1 or not 0 <= shard_index < num_shards:
+            raise ValueError(f"Invalid shard index {shard_index} for {num_shards} shards.")
+        if shard_dim not in ["basin", "time"]:
+            raise ValueError(f"Unsupported shard dimension: {shard_dim}")
+        if shuffle_mode not in ["full", "block"]:
+            raise ValueError(f"Unsupported shuffle mode: {shuffle_mode}")
+        if shard_dim == "basin" and joined_ouput and num_shards > 1:
+            raise ValueError("Sharding by basin is not supported for joined outputs. Use shard_dim='time' instead.")
+        if lumped:
+            xds = self.__lump_inputs(xds, feature_vars, geom_path, lumped_cache_path, epsg)
+            basin_indexed = True
         if all(i in xds.coords for i in ["basin", "time", "y", "x"]):
-            self.xds = xds.transpose("basin", "time", "y", "x")
+            xds = xds.transpose("basin", "time", "y", "x")
         elif all(i in xds.coords for i in ["basin", "time"]):
-            self.xds = xds.transpose("basin", "time")
+            xds = xds.transpose("basin", "time")
+        self.num_shards = num_shards
+        self.shard_index = shard_index
+        self.shard_dim = shard_dim
+        self.rebalance_shards = rebalance_shards
+        self.epoch = 0
+        self._xds_full = xds if rebalance_shards else None
         self.batch_size = batch_size
         self.timesteps = timesteps
         self.offset = offset
+        self.multi_horizon = isinstance(offset, (list, tuple, np.ndarray))
+        self.offsets = np.atleast_1d(offset).astype(int)
+        if self.offsets.min() < 1:
+            raise ValueError(f"Offsets must be positive, got {offset}.")
+        if len(np.unique(self.offsets)) != len(self.offsets):
+            raise ValueError(f"Offsets must not contain duplicates, got {offset}.")
+        # Deltas between the target of the smallest offset and the targets of all offsets in the given order
+        self.horizon_deltas = self.offsets - self.offsets.min()
+        # Number of timesteps preceding the target of the smallest offset and following it up to the largest offset
+        self.lag = self.timesteps + int(self.offsets.min()) - 1
+        self.lead = int(self.horizon_deltas.max())
         self.feature_vars = feature_vars
         self.target_var = target_var
         self.drop_na = drop_na
         self.joined_output = joined_ouput
         self.basin_indexed = basin_indexed
         self.input_shape = input_shape
-        self.idx_dict = self.__get_basin_idx_df(drop_na, joined_ouput)
-        if shuffle:
-            self.idx_dict = self.idx_dict.sample(frac=1).reset_index(drop=True)
-        self.ds_inputs = self.xds[feature_vars].to_array()
-        if joined_ouput:
-            self.ds_targets = self.xds[[target_var]].to_array()
-        else:
-            self.ds_targets = self.xds[[target_var]].to_array()
+        self.lumped = lumped
+        self.shuffle = shuffle
+        self.shuffle_mode = shuffle_mode
+        self.block_size = block_size
+        self.buffer_size = buffer_size if buffer_size else batch_size
+        self.seed = seed
+        # Lumped inputs are already held in memory, so there is no need for caching them
+        self.cache = LruCache(int(cache_size_mb * 1024 ** 2)) if cache_size_mb > 0 and not lumped else None
+        self.samples_per_shard = self.__get_samples_per_shard(xds) if num_shards > 1 else None
+        self.__init_shard(xds, shard_index)
+
+    def __get_samples_per_shard(self, xds: xarray.Dataset):
+        # Only the target variable is needed for computing the number of samples of each shard
+        xds_targets = xds[[self.target_var]]
+        return min(len(self.__get_basin_idx_df(self._select_shard(xds_targets, shard_pos), self.drop_na,
+                                               self.joined_output))
+                   for shard_pos in range(self.num_shards))
+
+    def __get_epoch_idx_df(self):
+        df_idx = self._shuffle_idx_df(self._idx_df) if self.shuffle else self._idx_df
+        if self.samples_per_shard is not None:
+            df_idx = df_idx[:self.samples_per_shard]
+        return df_idx
+
+    def __init_shard(self, xds: xarray.Dataset, shard_pos: int):
+        if self.cache is not None:
+            # Cache keys refer to the time indices of the current shard
+            self.cache.clear()
+        self.xds = self._select_shard(xds, shard_pos)
+        self._idx_df = self.__get_basin_idx_df(self.xds, self.drop_na, self.joined_output)
+        self.idx_dict = self.__get_epoch_idx_df()
+        self.ds_inputs = self.xds[self.feature_vars].to_array()
+        if self.lumped:
+            self.ds_inputs = self.ds_inputs.load()
+            if self.joined_output:
+                self.ds_inputs = self.ds_inputs.transpose("variable", "time", "basin")
+        self.ds_targets = self.xds[[self.target_var]].to_array()
+
+    @staticmethod
+    def __lump_inputs(xds: xarray.Dataset, feature_vars: list, geom_path: str, cache_path: str, epsg: int):
+        attrs = None
+        if geom_path is not None:
+            attrs = dict(geom_path=os.path.abspath(geom_path), geom_checksum=file_checksum(geom_path), epsg=epsg)
+        xds_lumped = None
+        if cache_path is not None and os.path.exists(cache_path):
+            with xarray.open_dataset(cache_path) as xds_cached:
+                # Without a geometry file the cache can not be validated and will be used as is
+                stored_attrs = {key: xds_cached.attrs.get(key) for key in attrs or {}}
+                if attrs is None or stored_attrs == attrs:
+                    xds_lumped = xds_cached.load()
+        if xds_lumped is None:
+            if geom_path is None:
+                raise ValueError("Lumped inputs require either a geometry file or an existing lumped cache file.")
+            # Imported on demand, since geopandas and rioxarray are only required for lumping
+            from libs.dwd import grid as dwdgrid
+            xds_lumped = dwdgrid.lump_by_geometries(xds, geom_path, feature_vars, epsg).load()
+            xds_lumped.attrs.update(attrs)
+            if cache_path is not None:
+                xds_lumped.to_netcdf(cache_path)
+        missing_vars = [var for var in feature_vars if var not in xds_lumped.data_vars]
+        if missing_vars:
+            raise ValueError(f"Lumped inputs do not contain the feature variables {missing_vars}.")
+        missing_times = np.setdiff1d(xds.time.values, xds_lumped.time.values)
+        if len(missing_times) > 0:
+            raise ValueError(f"Lumped inputs do not cover {len(missing_times)} timesteps of the dataset, starting "
+                             f"with {missing_times[0]}.")
+        missing_basins = np.setdiff1d(xds.basin.values, xds_lumped.basin.values)
+        if len(missing_basins) > 0:
+            raise ValueError(f"Lumped inputs do not contain the basins {list(missing_basins)}.")
+        xds_lumped = xds_lumped[feature_vars].sel(time=xds.time, basin=xds.basin)
+        xds = xds.drop_vars(feature_vars).drop_dims(["y", "x"], errors="ignore")
+        return xds.merge(xds_lumped).transpose("basin", "time")
+
+    def _select_shard(self, xds: xarray.Dataset, shard_pos: int):
+        """
+        Selects the slice of the xarray.Dataset that belongs to a certain shard. Basins are split into num_shards
+        groups of (almost) equal size. For time-based sharding, the valid target dates are split into num_shards
+        contiguous blocks and each block is extended by the preceding timesteps that are needed as inputs for its
+        first sample. Since only index-based selection is applied, lazily opened datasets stay lazy.
+
+        Parameters
+        ----------
+        xds: xarray.Dataset
+            Full dataset
+        shard_pos: int
+            Position of the shard to select
+
+        Returns
+        -------
+        xarray.Dataset:
+            Subset of the dataset for the given shard
+
+        """
+        if self.num_shards == 1:
+            return xds
+        if self.shard_dim == "basin":
+            basin_indices = np.array_split(np.arange(xds.basin.size), self.num_shards)[shard_pos]
+            return xds.isel(basin=basin_indices)
+        bounds = np.linspace(0, max(xds.time.size - self.lag - self.lead, 0), self.num_shards + 1).astype(int)
+        return xds.isel(time=slice(bounds[shard_pos], bounds[shard_pos + 1] + self.lag + self.lead))
+
+    def _shuffle_idx_df(self, df_idx: pd.DataFrame):
+        """
+        Shuffles the sample index by using a random number generator that is seeded with the seed and the current
+        epoch. In 'block' mode, the samples are grouped into blocks of block_size consecutive timesteps (per basin, if
+        inputs are basin indexed and not joined). The order of the blocks is shuffled and afterwards, the samples are
+        shuffled within consecutive buffers of buffer_size samples.
+
+        Parameters
+        ----------
+        df_idx: pandas.DataFrame
+            Sample index in its original order
+
+        Returns
+        -------
+        pandas.DataFrame:
+            Shuffled sample index
+
+        """
+        rng = np.random.default_rng(None if self.seed is None else [self.seed, self.epoch])
+        if self.shuffle_mode == "full" or len(df_idx) == 0:
+            return df_idx.iloc[rng.permutation(len(df_idx))].reset_index(drop=True)
 
-    def __get_basin_idx_df(self, drop_na: bool, joined_output: bool):
-        lag = self.timesteps + self.offset - 1
+        block_keys = df_idx["time_idx"].values // self.block_size
+        if self.basin_indexed and not self.joined_output:
+            block_keys = block_keys + df_idx["basin_idx"].values * (block_keys.max() + 1)
+        blocks = np.unique(block_keys)
+        block_order = np.empty(len(blocks), dtype=int)
+        block_order[rng.permutation(len(blocks))] = np.arange(len(blocks))
+        # Stable sort keeps the temporal order of samples within a block
+        order = np.argsort(block_order[np.searchsorted(blocks, block_keys)], kind="stable")
+        for start in range(0, len(order), self.buffer_size):
+            order[start:start + self.buffer_size] = rng.permutation(order[start:start + self.buffer_size])
+        return df_idx.iloc[order].reset_index(drop=True)
+
+    def on_epoch_end(self):
+        self.epoch += 1
+        if self.rebalance_shards and self.num_shards > 1:
+            self.__init_shard(self._xds_full, (self.shard_index + self.epoch) % self.num_shards)
+        elif self.shuffle:
+            self.idx_dict = self.__get_epoch_idx_df()
+
+    def __get_basin_idx_df(self, xds: xarray.Dataset, drop_na: bool, joined_output: bool):
+        # Index of the target for the smallest offset. Targets for further offsets follow at the horizon deltas.
+        horizon_deltas = self.horizon_deltas
 
         date_idx_list = []
         basin_idx_list = []
-        basins = self.xds.basin.values
+        basins = xds.basin.values
         for i, basin in enumerate(basins):
+            n_time = len(xds.sel(basin=basin)[self.target_var])
+            sel_indices = np.arange(self.lag, n_time - self.lead)
             if drop_na:
-                # Only consider streamflow values which are not NaN
-                non_nan_flags = np.invert(np.isnan(self.xds.sel(basin=basin).streamflow))
-                sel_indices = np.arange(0, len(self.xds.sel(basin=basin)[self.target_var]))[lag:][non_nan_flags.values[lag:]]
-            else:
-                sel_indices = np.arange(0, len(self.xds.sel(basin=basin)[self.target_var]))[lag:]
+                # Only consider samples whose streamflow values are not NaN for all offsets
+                non_nan_flags = np.invert(np.isnan(xds.sel(basin=basin)[self.target_var].values))
+                sel_indices = sel_indices[np.all(non_nan_flags[sel_indices[:, np.newaxis] + horizon_deltas], axis=1)]
             basin_idx_list.extend([i] * len(sel_indices))
             date_idx_list.extend(sel_indices)
         df_idx = pd.DataFrame({"basin_idx": basin_idx_list, "time_idx": date_idx_list})
         if joined_output:
             df_idx = df_idx.groupby("time_idx")["basin_idx"].apply(list).reset_index(name="basin_idx")
-            df_idx = df_idx[df_idx["basin_idx"].apply(len) == len(self.xds.basin.values)]
+            df_idx = df_idx[df_idx["basin_idx"].apply(len) == len(xds.basin.values)]
         return df_idx
 
     def __get_idx_df(self, drop_na: bool):
-        lag = self.timesteps + self.offset - 1
+        lag = self.lag
 
         date_idx_list = []
         basins = self.xds.basin.values
@@ -119,24 +342,28 @@ class CustomTimeseriesGenerator(Sequence):
         targets = np.empty(self._get_target_shape())
 
         for index, row in df_batch.iterrows():
-            start_date_idx = row.time_idx - self.timesteps
-            end_date_idx = row.time_idx - self.offset + 1
+            end_date_idx = row.time_idx - self.offsets.min() + 1
+            start_date_idx = end_date_idx - self.timesteps
+            target_idx = row.time_idx + self.horizon_deltas if self.multi_horizon else row.time_idx
             if self.joined_output:
-                forcings_values = self.ds_inputs[:, start_date_idx:end_date_idx, ...].values
+                forcings_values = self._get_forcings(None, start_date_idx, end_date_idx)
                 forcings_values = np.moveaxis(forcings_values, 0, -1)
                 inputs = np.vstack([inputs, np.expand_dims(forcings_values, axis=0)])
                 if self.basin_indexed:
-                    streamflow_values = self.ds_targets[:, row.basin_idx, row.time_idx].values
+                    streamflow_values = self.ds_targets[:, row.basin_idx, target_idx].values
                 else:
-                    streamflow_values = self.ds_targets[:, row.time_idx].values
+                    streamflow_values = self.ds_targets[:, target_idx].values
+                if self.multi_horizon:
+                    # (variable, basin, horizon) -> (1, horizon, basin)
+                    streamflow_values = np.moveaxis(streamflow_values, -1, 1)
                 targets = np.vstack([targets, streamflow_values])
             else:
                 if self.basin_indexed:
-                    forcings_values = self.ds_inputs[:, row.basin_idx, start_date_idx:end_date_idx, ...].values
-                    streamflow_values = self.ds_targets[:, row.basin_idx, row.time_idx].values
+                    forcings_values = self._get_forcings(row.basin_idx, start_date_idx, end_date_idx)
+                    streamflow_values = self.ds_targets[:, row.basin_idx, target_idx].values
                 else:
-                    forcings_values = self.ds_inputs[:, start_date_idx:end_date_idx, ...].values
-                    streamflow_values = self.ds_targets[:, row.time_idx].values
+                    forcings_values = self._get_forcings(None, start_date_idx, end_date_idx)
+                    streamflow_values = self.ds_targets[:, target_idx].values
                 forcings_values = np.moveaxis(forcings_values, 0, -1)
                 streamflow_values = np.moveaxis(streamflow_values, 0, -1)
                 inputs = np.vstack([inputs, np.expand_dims(forcings_values, axis=0)])
@@ -144,18 +371,61 @@ class CustomTimeseriesGenerator(Sequence):
 
         return inputs, targets
 
+    def _get_forcings(self, basin_idx, start_date_idx: int, end_date_idx: int):
+        """
+        Reads the input features for a time window with shape (variable, time, ...). If a cache is used, daily grids
+        are taken from the cache and only the time span that covers missing grids is read from the dataset.
+
+        Parameters
+        ----------
+        basin_idx: int
+            Index of the basin, if the inputs are basin indexed, else None
+        start_date_idx: int
+            Index of the first timestep of the window
+        end_date_idx: int
+            Index of the timestep following the window
+
+        Returns
+        -------
+        numpy.ndarray:
+            Input feature values of the time window
+
+        """
+        xda = self.ds_inputs if basin_idx is None else self.ds_inputs[:, basin_idx]
+        if self.cache is None:
+            return xda[:, start_date_idx:end_date_idx, ...].values
+
+        time_indices = range(start_date_idx, end_date_idx)
+        grids = {}
+        for v, var in enumerate(self.feature_vars):
+            for t in time_indices:
+                grids[v, t] = self.cache.get((var, basin_idx, t))
+        missing_times = [t for (v, t), grid in grids.items() if grid is None]
+        if missing_times:
+            read_start = min(missing_times)
+            values = xda[:, read_start:max(missing_times) + 1, ...].values
+            for (v, t), grid in grids.items():
+                if grid is None:
+                    grid = np.array(values[v, t - read_start, ...])
+                    self.cache.put((self.feature_vars[v], basin_idx, t), grid)
+                    grids[v, t] = grid
+        return np.stack([np.stack([grids[v, t] for t in time_indices]) for v in range(len(self.feature_vars))])
+
     def _get_input_shape(self):
         dim_indices = [dim for dim in self.xds[self.feature_vars].to_array().dims if
                        dim not in ["variable", "basin", "time"]]
         dim_size = tuple(self.xds[dim].size for dim in dim_indices)
+        if self.lumped and self.joined_output:
+            dim_size = (self.xds.basin.size,)
         return (0, self.timesteps) + dim_size + (len(self.feature_vars),)
 
     def _get_target_shape(self):
         dim_indices = [dim for dim in self.xds[[self.target_var]].to_array().dims if
                        dim not in ["variable", "basin", "time"]]
         dim_size = tuple(self.xds[dim].size for dim in dim_indices)
+        horizon = (len(self.offsets),) if self.multi_horizon else ()
         if self.joined_output:
-            return (0,) + dim_size + (len(self.xds.basin.values),)
+            return (0,) + horizon + dim_size + (len(self.xds.basin.values),)
         else:
-            return (0,) + dim_size + (1,)
+            return (0,) + horizon + dim_size + (1,)
 
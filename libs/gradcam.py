@@ -1,11 +1,25 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
 import tensorflow as tf
+import xarray as xr
 from PIL import Image
 
-def create_grad_cam_heatmap(model, inputs, pred_index, last_conv_layer, scale_across_time):
-    grad_model = tf.keras.models.Model(
-        [model.inputs], [model.get_layer(last_conv_layer).output, model.output]
+SEASONS = ["DJF", "MAM", "JJA", "SON"]
+
+
+def create_grad_model(model, layer):
+    return tf.keras.models.Model(
+        [model.inputs], [model.get_layer(layer).output, model.output]
     )
 
+
+def create_grad_cam_heatmap(model, inputs, pred_index, last_conv_layer, scale_across_time, grad_model=None):
+    if grad_model is None:
+        grad_model = create_grad_model(model, last_conv_layer)
+
     with tf.GradientTape() as tape:
         feature_maps, cnn_preds = grad_model(inputs)
         # if cnn_pred_index is None:
@@ -50,11 +64,10 @@ def create_grad_cam_heatmap(model, inputs, pred_index, last_conv_layer, scale_ac
     return heatmap_list
 
 
-def create_grad_lstm_cam_heatmap(model, inputs, pred_index, last_conv_layer, last_lstm_layer, mixed_weighting, scale_across_time):
-
-    grad_model = tf.keras.models.Model(
-        [model.inputs], [model.get_layer(last_conv_layer).output, model.output]
-    )
+def create_grad_lstm_cam_heatmap(model, inputs, pred_index, last_conv_layer, last_lstm_layer, mixed_weighting,
+                                 scale_across_time, grad_model=None, lstm_grad_model=None):
+    if grad_model is None:
+        grad_model = create_grad_model(model, last_conv_layer)
 
     with tf.GradientTape() as tape:
         feature_maps, cnn_preds = grad_model(inputs)
@@ -67,9 +80,8 @@ def create_grad_lstm_cam_heatmap(model, inputs, pred_index, last_conv_layer, las
 
     feature_maps = feature_maps[0]
 
-    lstm_grad_model = tf.keras.models.Model(
-        [model.inputs], [model.get_layer(last_lstm_layer).output, model.output]
-    )
+    if lstm_grad_model is None:
+        lstm_grad_model = create_grad_model(model, last_lstm_layer)
 
     with tf.GradientTape() as lstm_tape:
         lstm_feature_maps, lstm_preds = lstm_grad_model(inputs)
@@ -114,3 +126,140 @@ def create_grad_lstm_cam_heatmap(model, inputs, pred_index, last_conv_layer, las
         heatmap_list.append(image_heatmap)
 
     return heatmap_list
+
+
+def run_grad_cam_attribution(model, generator, out_path: str, basins: list, last_conv_layer: str,
+                             last_lstm_layer: str = None, mixed_weighting: bool = False, scale_across_time: bool = True,
+                             n_workers: int = 4):
+    """
+    Computes Grad-CAM heatmaps for all samples of a generator and all basins and stores them within a compressed
+    Zarr store with the dimensions (sample, basin, timestep, y, x), chunked by sample. If a last LSTM layer is given,
+    LSTM weighted heatmaps will be computed. Samples of a generator batch are processed in parallel by a pool of worker
+    threads and each batch is appended to the store as soon as it has been processed. If the store already exists,
+    processing resumes with the first sample that has not been stored yet. Therefore, the generator must not shuffle
+    its samples. Layer names and weighting options are stored as attributes, and a ValueError is raised if they, the
+    sample times or the basins of an existing store do not match the current run.
+
+    Mean heatmaps per season and basin are aggregated on the fly, so that the heatmaps of all samples never have to be
+    kept in memory. NaN cells of single heatmaps are ignored, i.e. each cell is averaged over its valid samples only.
+
+    Parameters
+    ----------
+    model: tf.keras.Model
+        Model to explain
+    generator: libs.generator.CustomTimeseriesGenerator
+        Generator that provides the input samples
+    out_path: str
+        Path of the Zarr store for the heatmaps
+    basins: list
+        Basin IDs in the order of the model outputs
+    last_conv_layer: str
+        Name of the last convolutional layer
+    last_lstm_layer: str
+        Name of the last LSTM layer. If specified, LSTM weighted heatmaps will be computed.
+    mixed_weighting: bool
+        Indicates whether LSTM gradients should be mixed with pooled CNN gradients for weighting the feature maps
+    scale_across_time: bool
+        Indicates whether heatmaps should be scaled across all timesteps or for each timestep separately
+    n_workers: int
+        Number of worker threads. Default: 4
+
+    Returns
+    -------
+    xarray.Dataset:
+        Dataset with mean heatmaps, number of valid samples per cell and number of samples per season
+
+    """
+    if generator.shuffle:
+        raise ValueError("Attribution requires a generator that does not shuffle its samples.")
+
+    grad_model = create_grad_model(model, last_conv_layer)
+    lstm_grad_model = create_grad_model(model, last_lstm_layer) if last_lstm_layer is not None else None
+
+    def create_sample_heatmaps(inputs):
+        heatmaps = []
+        for pred_index in range(0, len(basins)):
+            if lstm_grad_model is None:
+                heatmap_list = create_grad_cam_heatmap(model, inputs, pred_index, last_conv_layer, scale_across_time,
+                                                       grad_model=grad_model)
+            else:
+                heatmap_list = create_grad_lstm_cam_heatmap(model, inputs, pred_index, last_conv_layer,
+                                                            last_lstm_layer, mixed_weighting, scale_across_time,
+                                                            grad_model=grad_model, lstm_grad_model=lstm_grad_model)
+            heatmaps.append(np.stack(heatmap_list)[..., 0])
+        return np.stack(heatmaps).astype(np.float32)
+
+    sample_times = generator.xds.time.values[generator.idx_dict["time_idx"].values]
+    sample_seasons = pd.DatetimeIndex(sample_times).month % 12 // 3
+    heatmap_sums = None
+    valid_counts = None
+    sample_counts = np.zeros(len(SEASONS), dtype=int)
+
+    def update_aggregates(heatmaps, start):
+        # Heatmaps may contain NaN cells (e.g. if a heatmap is zero everywhere and has been scaled by its maximum).
+        # These are skipped, so that a single invalid sample does not invalidate the mean of a whole season.
+        nonlocal heatmap_sums, valid_counts
+        if heatmap_sums is None:
+            heatmap_sums = np.zeros((len(SEASONS),) + heatmaps.shape[1:], dtype=np.float64)
+            valid_counts = np.zeros((len(SEASONS),) + heatmaps.shape[1:], dtype=int)
+        for heatmap, season in zip(heatmaps, sample_seasons[start:start + len(heatmaps)]):
+            heatmap_sums[season] += np.nan_to_num(heatmap, nan=0.)
+            valid_counts[season] += ~np.isnan(heatmap)
+            sample_counts[season] += 1
+
+    attrs = dict(last_conv_layer=last_conv_layer, last_lstm_layer=last_lstm_layer or "",
+                 mixed_weighting=int(mixed_weighting), scale_across_time=int(scale_across_time))
+
+    n_done = 0
+    if os.path.exists(out_path):
+        xds_done = xr.open_zarr(out_path)
+        xda_done = xds_done["heatmap"]
+        n_done = xda_done.sizes["sample"]
+        stored_attrs = {key: xds_done.attrs.get(key) for key in attrs}
+        if stored_attrs != attrs:
+            raise ValueError(f"Stored heatmaps have been created with {stored_attrs}, but the current run uses "
+                             f"{attrs}.")
+        if list(xds_done.basin.values) != list(basins):
+            raise ValueError(f"Stored basins {list(xds_done.basin.values)} do not match the basins {list(basins)}.")
+        if n_done > len(sample_times) or not np.array_equal(xds_done.time.values, sample_times[:n_done]):
+            raise ValueError("Stored sample times do not match the samples of the generator.")
+        print(f"Resume attribution after {n_done} stored samples.")
+        for start in range(0, n_done, generator.batch_size):
+            update_aggregates(xda_done[start:start + generator.batch_size].values, start)
+
+    batch_size = generator.batch_size
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        for batch_idx in range(n_done // batch_size, len(generator)):
+            print(f"Processing batch {batch_idx + 1} of {len(generator)}", end="\r")
+            inputs, _ = generator[batch_idx]
+            start = max(batch_idx * batch_size, n_done)
+            offset = start - batch_idx * batch_size
+            if offset >= len(inputs):
+                continue
+            heatmaps = np.stack(list(executor.map(create_sample_heatmaps,
+                                                  [inputs[i:i + 1] for i in range(offset, len(inputs))])))
+            update_aggregates(heatmaps, start)
+
+            xds_batch = xr.Dataset(
+                data_vars=dict(heatmap=(["sample", "basin", "timestep", "y", "x"], heatmaps)),
+                coords=dict(sample=np.arange(start, start + len(heatmaps)),
+                            time=("sample", sample_times[start:start + len(heatmaps)]),
+                            basin=basins),
+                attrs=attrs
+            )
+            if start == 0:
+                xds_batch.to_zarr(out_path, mode="w",
+                                  encoding={"heatmap": {"chunks": (1,) + heatmaps.shape[1:]}})
+            else:
+                xds_batch.to_zarr(out_path, append_dim="sample")
+
+    if heatmap_sums is None:
+        raise ValueError("Generator does not provide any samples.")
+    with np.errstate(divide="ignore", invalid="ignore"):
+        heatmap_means = heatmap_sums / valid_counts
+    return xr.Dataset(
+        data_vars=dict(heatmap_mean=(["season", "basin", "timestep", "y", "x"], heatmap_means),
+                       valid_count=(["season", "basin", "timestep", "y", "x"], valid_counts),
+                       sample_count=(["season"], sample_counts)),
+        coords=dict(season=SEASONS, basin=basins)
+    )
@@ -0,0 +1,32 @@
+import importlib.util
+import sys
+
+
+def lazy_import(name: str):
+    """
+    Imports a module lazily, which means that the module will be registered immediately, but executed only when one
+    of its attributes is accessed for the first time. This avoids paying the import time of heavy dependencies for
+    code paths, which do not need them.
+
+    Parameters
+    ----------
+    name: str
+        Name of a top-level module (e.g. 'geopandas')
+
+    Returns
+    -------
+    module:
+        The lazily loaded module
+
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
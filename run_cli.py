@@ -0,0 +1,5 @@
+from libs import cli
+
+
+if __name__ == "__main__":
+    cli.main()
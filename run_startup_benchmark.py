@@ -0,0 +1,67 @@
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+HEAVY_MODULES = ["numpy", "pandas", "xarray", "rioxarray", "geopandas", "rasterio", "tensorflow", "requests"]
+
+# Statements that resemble the startup of each CLI subcommand up to the point where the actual work begins
+SCENARIOS = {
+    "cli": "from libs import cli; cli.create_parser()",
+    "download": "from libs import cli; from libs.dwd import cdc",
+    "catalog": "from libs import cli; from libs.dwd import catalog",
+    "load": "from libs import cli; from libs.dwd import catalog, grid",
+}
+
+
+def measure(statement: str, repeats: int):
+    """
+    Measures the wall time of starting a fresh Python interpreter and executing a statement.
+
+    Parameters
+    ----------
+    statement: str
+        Python statement to execute
+    repeats: int
+        Number of measurements
+
+    Returns
+    -------
+    tuple:
+        Median time in seconds and list of heavy modules, which have been imported by executing the statement.
+
+    """
+    # Modules imported by libs.lazy.lazy_import are registered in sys.modules as _LazyModule until their first use.
+    # type() does not trigger loading them, so only modules, which have actually been executed, are reported.
+    report = (f"import sys; print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules and "
+              f"type(sys.modules[m]).__name__ != '_LazyModule'))")
+    times = []
+    modules = ""
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, "-c", f"{statement}\n{report}"], capture_output=True, text=True)
+        times.append(time.perf_counter() - start)
+        if result.returncode != 0:
+            return None, result.stderr.strip().splitlines()[-1]
+        modules = result.stdout.strip()
+    return statistics.median(times), modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the startup time of the CLI subcommands.")
+    parser.add_argument("-n", "--repeats", type=int, default=5, help="Number of measurements per scenario.")
+    args = parser.parse_args()
+
+    baseline, _ = measure("pass", args.repeats)
+    print(f"{'scenario':<10} {'median [s]':>10} {'overhead [s]':>12}  heavy modules")
+    for name, statement in SCENARIOS.items():
+        median, modules = measure(statement, args.repeats)
+        if median is None:
+            print(f"{name:<10} {'failed':>10} {'':>12}  {modules}")
+        else:
+            print(f"{name:<10} {median:>10.3f} {median - baseline:>12.3f}  {modules or '-'}")
+
+
+if __name__ == "__main__":
+    main()